@@ -1,11 +1,27 @@
 import streamlit as st
 import pandas as pd
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
 import gspread
+import hashlib
 import io
 import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+# Imported once at server boot rather than inside get_google_clients: the
+# Vertex SDK pulls in hundreds of submodules (~600-900ms cold), which would
+# otherwise block the first page render. Guarded so a missing SDK still
+# surfaces through get_google_clients' error handling.
+try:
+    from google.cloud import aiplatform
+    from vertexai.generative_models import GenerativeModel, GenerationConfig, Part
+except ImportError:
+    aiplatform = GenerativeModel = GenerationConfig = Part = None
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -34,34 +50,49 @@ def get_google_clients():
             ]
         )
         
-        # Import and initialize Vertex AI
-        from google.cloud import aiplatform
-        import vertexai
-        from vertexai.generative_models import GenerativeModel, Part
-
+        # Initialize Vertex AI (the SDK itself is imported at module top)
         aiplatform.init(project=st.secrets["GCP_PROJECT_ID"], location='us-central1', credentials=creds)
-        model = GenerativeModel("gemini-1.5-flash-001")
+        # The invariant OCR persona lives in the system instruction so each
+        # prompt doesn't have to repeat it.
+        model = GenerativeModel(
+            "gemini-1.5-flash-001",
+            system_instruction="You are an expert OCR data extractor for agricultural commodity bills. Always reply in strict JSON.")
         
         # Build other Google services
-        drive_service = build('drive', 'v3', credentials=creds)
-        gspread_client = gspread.authorize(creds)
-        
-        return drive_service, gspread_client, model
+        drive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        sheets_service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
+
+        # Hand gspread a pre-authorized keep-alive session so its requests
+        # reuse one connection instead of re-checking auth per call.
+        session = AuthorizedSession(creds)
+        session.headers['Connection'] = 'keep-alive'
+        gspread_client = gspread.Client(auth=creds, session=session)
+
+        # Fire-and-forget ping so the first real call in the session hits a
+        # warm TLS connection instead of paying the 1-2s cold-start penalty.
+        def _warm_up():
+            try:
+                model.generate_content("ok", generation_config=GenerationConfig(max_output_tokens=1))
+            except Exception:
+                pass
+        threading.Thread(target=_warm_up, daemon=True).start()
+
+        return drive_service, sheets_service, gspread_client, model
 
     except Exception as e:
         st.error(f"Failed to initialize Google clients: {e}")
         st.exception(e)
-        return None, None, None
+        return None, None, None, None
 
 
 # --- Initialize Clients and Load Global Variables ---
 try:
-    drive_service, gspread_client, gemini_model = get_google_clients()
+    drive_service, sheets_service, gspread_client, gemini_model = get_google_clients()
     GOOGLE_SHEET_ID = st.secrets["GOOGLE_SHEET_ID"]
     GOOGLE_DRIVE_FOLDER_ID = st.secrets["GOOGLE_DRIVE_FOLDER_ID"]
 
     # Check if the initialization was successful
-    if not all([drive_service, gspread_client, gemini_model]):
+    if not all([drive_service, sheets_service, gspread_client, gemini_model]):
         st.error("Could not initialize one or more Google services. The app cannot continue.")
         st.stop()
 
@@ -71,56 +102,129 @@ except KeyError as e:
     st.stop()
 
 
+@st.cache_resource
+def get_executor():
+    """Returns a shared thread pool for overlapping independent network calls."""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+@st.cache_resource
+def get_generation_config():
+    """Builds the JSON-schema generation config once so Gemini returns parse-ready output."""
+    schema = {
+        "type": "object",
+        "properties": {
+            "bill_type": {"type": "string"},
+            "party_name": {"type": "string"},
+            "fields": {
+                "type": "object",
+                "properties": {
+                    "Contract No": {"type": "string"},
+                    "Bill No": {"type": "string"},
+                    "Date": {"type": "string"},
+                    "Lorry No": {"type": "string"},
+                    "Party Name": {"type": "string"},
+                    "Weight": {"type": "string"},
+                    "Rate": {"type": "string"},
+                    "Bags": {"type": "string"},
+                    "Quality": {"type": "string"},
+                },
+            },
+        },
+        "required": ["bill_type", "party_name", "fields"],
+    }
+    return GenerationConfig(temperature=0, response_mime_type="application/json", response_schema=schema)
+
+
+# Fallback cleanup for the rare response that still arrives fenced: one
+# precompiled pass that strips only leading/trailing ``` markers, instead of
+# the old three-scan strip/replace that also mangled any "json" in the data.
+_CLEAN_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.DOTALL)
+
+
 # --- Core Processing Functions ---
-def analyze_bill_type_and_party(image_bytes):
-    """Uses Gemini to identify if it's a Loading/Unloading bill and find the primary party name."""
-    if not gemini_model: return None, None
-    from vertexai.generative_models import Part
-    prompt = """Analyze this image of a bill. Your task is to determine two things: 1. Bill Type: Is this a "Loading Bill" or an "Unloading Bill"? - A Loading Bill usually has the seller's name prominently at the top. - An Unloading Bill usually has the buyer's name prominently at the top. 2. Party Name: Extract the full name of this primary party. Provide the output in a clean JSON format with keys "bill_type" and "party_name"."""
-    image_part = Part.from_data(image_bytes, mime_type="image/jpeg")
-    response = gemini_model.generate_content([prompt, image_part])
-    try:
-        cleaned_response = response.text.strip().replace("`", "").replace("json", "")
-        data = json.loads(cleaned_response)
-        return data.get("bill_type"), data.get("party_name")
-    except (json.JSONDecodeError, AttributeError, KeyError) as e:
-        st.error(f"Error parsing Gemini's first response: {e}")
-        st.text_area("Gemini Raw Response", response.text)
-        return None, None
-
-def extract_bill_details(image_bytes):
-    """Uses Gemini to extract specific fields from the bill."""
-    if not gemini_model: return None
-    from vertexai.generative_models import Part
-    prompt = """You are an expert OCR data extractor for agricultural commodity bills. From the provided image, extract the following fields. If a field is not present, use "N/A". - Contract No: (P.O. No. or Contract No.), Bill No:, Date:, Lorry No: (Vehicle No. or Truck/Gadi Number), Party Name: (Buyer/Seller Name), Weight: (Total weight or 'Vajan' in kg), Rate: (Rate or 'Bhav'), Bags: (Total bags/Katte/Bore), Quality: (The type of commodity, e.g., Paddy, IR धान, Rice, etc.). Provide the output as a single, clean JSON object."""
+def compress_image(image_file, max_side=1600, quality=80):
+    """Downscales and re-encodes an uploaded image file as JPEG to cut Gemini vision tokens and upload size.
+
+    Reads the file-like upload in place rather than snapshotting its bytes,
+    so the original multi-megabyte photo is never copied; only the small
+    compressed buffer stays resident.
+    """
+    image_file.seek(0)
+    image = Image.open(image_file)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def analyze_and_extract(image_bytes):
+    """Uses a single Gemini call to classify the bill and extract all its fields.
+
+    Returns (data, parse_error, raw_text). Runs on the shared executor, so it
+    must not call st.* itself - those are no-ops outside the script thread;
+    the caller renders any parse failure.
+    """
+    if not gemini_model: return None, None, None
+    prompt = """Analyze this image of a bill and do two things: 1. Classification: Determine the "bill_type" - is this a "Loading Bill" or an "Unloading Bill"? - A Loading Bill usually has the seller's name prominently at the top. - An Unloading Bill usually has the buyer's name prominently at the top. Extract the full name of this primary party as "party_name". 2. Extraction: Extract the following fields into a "fields" object. If a field is not present, use "N/A". - Contract No: (P.O. No. or Contract No.), Bill No:, Date:, Lorry No: (Vehicle No. or Truck/Gadi Number), Party Name: (Buyer/Seller Name), Weight: (Total weight or 'Vajan' in kg), Rate: (Rate or 'Bhav'), Bags: (Total bags/Katte/Bore), Quality: (The type of commodity, e.g., Paddy, IR धान, Rice, etc.)."""
     image_part = Part.from_data(image_bytes, mime_type="image/jpeg")
-    response = gemini_model.generate_content([prompt, image_part])
+    response = gemini_model.generate_content([prompt, image_part], generation_config=get_generation_config())
     try:
-        cleaned_response = response.text.strip().replace("`", "").replace("json", "")
-        return json.loads(cleaned_response)
+        try:
+            return json.loads(response.text), None, None
+        except json.JSONDecodeError:
+            return json.loads(_CLEAN_RE.sub("", response.text.strip())), None, None
     except (json.JSONDecodeError, AttributeError) as e:
-        st.error(f"Error parsing Gemini's second response: {e}")
-        st.text_area("Gemini Raw Response", response.text)
-        return None
+        return None, str(e), getattr(response, "text", "")
+
+@st.cache_resource
+def _party_folder_map():
+    """Lists all party subfolders once per session and caches a {name: id} map."""
+    query = f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+    folders = []
+    request = drive_service.files().list(q=query, spaces='drive', fields='nextPageToken, files(id, name)', pageSize=1000)
+    while request is not None:
+        response = request.execute()
+        folders.extend(response.get('files', []))
+        request = drive_service.files().list_next(request, response)
+    return {folder['name']: folder['id'] for folder in folders}
 
 def get_or_create_drive_folder(party_name):
-    """Finds a subfolder by name in the main Drive folder, or creates it if not found."""
+    """Finds a subfolder by name in the cached folder map, or creates it if not found."""
     if not drive_service: return None
-    query = f"'{GOOGLE_DRIVE_FOLDER_ID}' in parents and name = '{party_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    response = drive_service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-    items = response.get('files', [])
-    if items:
-        return items[0]['id']
-    else:
-        file_metadata = {'name': party_name, 'mimeType': 'application/vnd.google-apps.folder', 'parents': [GOOGLE_DRIVE_FOLDER_ID]}
-        folder = drive_service.files().create(body=file_metadata, fields='id').execute()
-        return folder.get('id')
+    folder_map = _party_folder_map()
+    if party_name in folder_map:
+        return folder_map[party_name]
+    file_metadata = {'name': party_name, 'mimeType': 'application/vnd.google-apps.folder', 'parents': [GOOGLE_DRIVE_FOLDER_ID]}
+    folder = drive_service.files().create(body=file_metadata, fields='id').execute()
+    folder_map[party_name] = folder.get('id')
+    return folder_map[party_name]
 
-def upload_to_drive(folder_id, file_name, image_bytes):
+def _next_drive_file_id():
+    """Pops a pre-generated Drive file ID, refilling the pool when it runs dry.
+
+    Pre-generated IDs make the create call safely retryable if its response
+    is dropped. Must be called from the script thread, before the upload is
+    handed to the executor: the pool lives in st.session_state, and the
+    refill shares drive_service's httplib2 transport, which must never be
+    used from two threads at once.
+    """
+    pool = st.session_state.setdefault("drive_id_pool", [])
+    if not pool:
+        pool.extend(drive_service.files().generateIds(count=10, space='drive').execute().get('ids', []))
+    return pool.pop()
+
+def upload_to_drive(folder_id, file_name, image_bytes, file_id=None):
     """Uploads the image file to the specified Google Drive folder."""
     if not drive_service: return None
-    media = MediaIoBaseUpload(io.BytesIO(image_bytes), mimetype='image/jpeg', resumable=True)
+    # Resumable uploads cost an extra session-initiation round-trip; only
+    # worth it above Drive's 5 MB simple-upload threshold, which compressed
+    # bills rarely reach.
+    media = MediaIoBaseUpload(io.BytesIO(image_bytes), mimetype='image/jpeg', resumable=len(image_bytes) >= 5 * 1024 * 1024)
     file_metadata = {'name': file_name, 'parents': [folder_id]}
+    if file_id:
+        file_metadata['id'] = file_id
     file = drive_service.files().create(body=file_metadata, media_body=media, fields='id, webViewLink').execute()
     return file.get('webViewLink')
 
@@ -136,20 +240,75 @@ def get_or_create_worksheet(party_name):
                 return sheet
         return spreadsheet.add_worksheet(title=party_name, rows="100", cols="20")
 
+def _read_sheet_schema(sheet_id):
+    """Reads the stored header list from the worksheet's developerMetadata, if present."""
+    body = {'dataFilters': [{'developerMetadataLookup': {
+        'metadataKey': 'bill_schema',
+        'metadataLocation': {'sheetId': sheet_id}}}]}
+    result = sheets_service.spreadsheets().developerMetadata().search(
+        spreadsheetId=GOOGLE_SHEET_ID, body=body).execute()
+    matches = result.get('matchedDeveloperMetadata', [])
+    if matches:
+        return json.loads(matches[0]['developerMetadata']['metadataValue'])
+    return None
+
+def _write_sheet_schema(sheet_id, headers):
+    """Stores the header list as developerMetadata so later sessions skip the header read."""
+    requests = [
+        {'deleteDeveloperMetadata': {'dataFilter': {'developerMetadataLookup': {
+            'metadataKey': 'bill_schema',
+            'metadataLocation': {'sheetId': sheet_id}}}}},
+        {'createDeveloperMetadata': {'developerMetadata': {
+            'metadataKey': 'bill_schema',
+            'metadataValue': json.dumps(headers),
+            'location': {'sheetId': sheet_id},
+            'visibility': 'DOCUMENT'}}},
+    ]
+    sheets_service.spreadsheets().batchUpdate(
+        spreadsheetId=GOOGLE_SHEET_ID, body={'requests': requests}).execute()
+
+@st.cache_data(ttl=3600)
+def get_party_folder_id(party_name):
+    """Cached wrapper so repeat uploads for a party skip the Drive folder lookup."""
+    return get_or_create_drive_folder(party_name)
+
+@st.cache_resource(ttl=3600)
+def get_party_worksheet(party_name):
+    """Cached wrapper so repeat uploads for a party skip the spreadsheet metadata fetch."""
+    return get_or_create_worksheet(party_name)
+
 def update_google_sheet(worksheet, data_dict):
     """Appends data to the Google Sheet, adding headers if needed."""
     if not worksheet: return
-    headers = worksheet.row_values(1)
+    # Go through the shared sheets_service rather than gspread: it reuses
+    # one authorized HTTP session (no fresh TLS handshake per mutation) and
+    # the append is a single values.append call.
+    # A1 notation escapes embedded single quotes by doubling them; party
+    # names come verbatim from OCR and can contain apostrophes.
+    sheet_name = "'{}'".format(worksheet.title.replace("'", "''"))
+    headers_cache = st.session_state.setdefault("headers_by_sheet", {})
+    headers = headers_cache.get(worksheet.title)
+    if headers is None:
+        # Prefer the schema stored in developerMetadata; fall back to
+        # reading the header row only when the metadata is missing.
+        headers = _read_sheet_schema(worksheet.id)
+    if headers is None:
+        result = sheets_service.spreadsheets().values().get(
+            spreadsheetId=GOOGLE_SHEET_ID, range=f"{sheet_name}!1:1").execute()
+        headers = result.get('values', [[]])[0]
     new_headers = [h for h in data_dict.keys() if h not in headers]
     if new_headers:
-        if not headers:
-             worksheet.update('A1', [list(data_dict.keys())])
-        else:
-            start_col = gspread.utils.rowcol_to_a1(1, len(headers) + 1)
-            worksheet.update(start_col, [new_headers])
-    all_headers = worksheet.row_values(1)
-    new_row = [data_dict.get(h, "") for h in all_headers]
-    worksheet.append_row(new_row, value_input_option='USER_ENTERED')
+        headers = headers + new_headers
+        sheets_service.spreadsheets().values().update(
+            spreadsheetId=GOOGLE_SHEET_ID, range=f"{sheet_name}!A1",
+            valueInputOption='RAW', body={'values': [headers]}).execute()
+        _write_sheet_schema(worksheet.id, headers)
+    new_row = [data_dict.get(h, "") for h in headers]
+    sheets_service.spreadsheets().values().append(
+        spreadsheetId=GOOGLE_SHEET_ID, range=f"{sheet_name}!A1",
+        valueInputOption='USER_ENTERED', insertDataOption='INSERT_ROWS',
+        body={'values': [new_row]}).execute()
+    headers_cache[worksheet.title] = headers
 
 # --- Streamlit UI ---
 st.title("AI Bill Processor by Rishabh Corporation")
@@ -158,35 +317,77 @@ st.markdown("Upload a Loading or Unloading Bill to automatically extract data, f
 uploaded_file = st.file_uploader("Choose a bill image...", type=["jpg", "jpeg", "png"])
 
 if uploaded_file is not None:
-    image_bytes = uploaded_file.getvalue()
+    # Phone photos of bills are often 3-8 MB; compressing first shrinks the
+    # Gemini and Drive payloads 5-20x with no loss of OCR accuracy.
+    image_bytes = compress_image(uploaded_file)
+
+    # Re-uploads of an identical bill short-circuit the whole pipeline: a
+    # cheap content hash replaces the Gemini call, Drive upload and append.
+    image_key = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    processed = st.session_state.setdefault("processed", {})
+
+    if image_key in processed:
+        bill_type, party_name, extracted_data, drive_link = processed[image_key]
+        st.image(image_bytes, caption="Uploaded Bill", width=300)
+        st.info(f"Detected **{bill_type}** for party: **{party_name}**")
+        st.success("🎉 This bill was already processed in this session!")
+        st.markdown(f"**Image successfully filed in Google Drive.** [View File]({drive_link})")
+        st.write("Extracted Data:")
+        st.json(extracted_data)
+        st.stop()
+
+    # One Gemini call classifies the bill and extracts its fields, so the
+    # image is only uploaded and prefilled once. Submit it before rendering
+    # the preview so Gemini's prefill overlaps the image serialization.
+    analyze_future = get_executor().submit(analyze_and_extract, image_bytes)
     st.image(image_bytes, caption="Uploaded Bill", width=300)
 
-    with st.spinner("Analyzing bill type and party name..."):
-        bill_type, party_name = analyze_bill_type_and_party(image_bytes)
-    
+    with st.spinner("Analyzing bill and extracting data..."):
+        analysis, parse_error, raw_text = analyze_future.result()
+
+    if parse_error:
+        st.error(f"Error parsing Gemini's response: {parse_error}")
+        st.text_area("Gemini Raw Response", raw_text)
+
+    bill_type = analysis.get("bill_type") if analysis else None
+    party_name = analysis.get("party_name") if analysis else None
+    extracted_data = analysis.get("fields") if analysis else None
+
     if bill_type and party_name:
         st.info(f"Detected **{bill_type}** for party: **{party_name}**")
-        
+
         with st.spinner(f"Processing... Creating folder and sheet for {party_name}..."):
-            drive_folder_id = get_or_create_drive_folder(party_name)
-            worksheet = get_or_create_worksheet(party_name)
-        
-        with st.spinner("Uploading image to Google Drive..."):
-            file_name = uploaded_file.name
-            drive_link = upload_to_drive(drive_folder_id, file_name, image_bytes)
-            
-        with st.spinner("Extracting detailed data from the bill..."):
-            extracted_data = extract_bill_details(image_bytes)
+            drive_folder_id = get_party_folder_id(party_name)
+            worksheet = get_party_worksheet(party_name)
+
+        # The upload's webViewLink is only needed for the final success
+        # message, so let it run in the background while the sheet updates.
+        upload_future = get_executor().submit(
+            upload_to_drive, drive_folder_id, uploaded_file.name, image_bytes, _next_drive_file_id())
 
         if extracted_data:
             with st.spinner("Updating Google Sheet..."):
                 update_google_sheet(worksheet, extracted_data)
-            
+
+            with st.spinner("Uploading image to Google Drive..."):
+                drive_link = upload_future.result()
+
+            processed[image_key] = (bill_type, party_name, extracted_data, drive_link)
+
             st.success("🎉 Process Complete!")
             st.markdown(f"**Image successfully filed in Google Drive.** [View File]({drive_link})")
             st.write("Extracted Data:")
             st.json(extracted_data)
         else:
             st.error("Could not extract detailed data from the bill. Please check the image quality.")
+            # The upload was already in flight; still resolve it so the user
+            # gets the link (or the upload error) instead of a leaked future.
+            with st.spinner("Uploading image to Google Drive..."):
+                try:
+                    drive_link = upload_future.result()
+                except Exception as e:
+                    st.error(f"Uploading the image to Google Drive also failed: {e}")
+                else:
+                    st.markdown(f"**The image was still filed in Google Drive.** [View File]({drive_link})")
     else:
         st.error("Could not determine the bill type or party name. The AI might have had trouble reading the image.")